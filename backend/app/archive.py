@@ -0,0 +1,189 @@
+"""Rolling archive of chat history for inactive sessions.
+
+Messages of sessions without activity for CHAT_ARCHIVE_INACTIVE_DAYS are
+moved out of chat_messages into gzip-compressed JSON lines segments under
+ARCHIVE_FOLDER/<session_code>/, keeping the newest CHAT_HOT_MESSAGES in
+MySQL. Segments are append-only and numbered in order, so the archive is
+always the older prefix of a session's history. Run it periodically:
+
+    python -m app.archive
+"""
+import gzip
+import json
+import os
+import shutil
+from datetime import datetime
+from typing import Optional
+from app.config import settings
+from app.database import get_db_connection
+from app.sharding import all_shards
+
+
+def _session_folder(session_code: str) -> str:
+    return os.path.join(settings.ARCHIVE_FOLDER, session_code)
+
+
+def _segments(session_code: str) -> list:
+    """Segment paths of a session, oldest first"""
+    folder = _session_folder(session_code)
+    if not os.path.isdir(folder):
+        return []
+    return [os.path.join(folder, name) for name in sorted(os.listdir(folder)) if name.endswith(".jsonl.gz")]
+
+
+def _segment_range(path: str) -> Optional[tuple]:
+    """First and last message id of a segment, None for segments named without them"""
+    parts = os.path.basename(path).split(".")[0].split("-")
+    return (int(parts[1]), int(parts[2])) if len(parts) == 3 else None
+
+
+def _read_segment(path: str) -> list:
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def _write_segment(session_code: str, messages: list):
+    folder = _session_folder(session_code)
+    os.makedirs(folder, exist_ok=True)
+    segments = _segments(session_code)
+    sequence = int(os.path.basename(segments[-1]).split(".")[0].split("-")[0]) + 1 if segments else 1
+    path = os.path.join(folder, f"{sequence:06d}-{messages[0]['id']}-{messages[-1]['id']}.jsonl.gz")
+
+    tmp_path = path + ".tmp"
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+        for message in messages:
+            f.write(json.dumps(message, default=str) + "\n")
+    with open(tmp_path, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def has_archive(session_code: str) -> bool:
+    return bool(_segments(session_code))
+
+
+def read_archived_messages(session_code: str, session_id: int, before_id: Optional[int] = None,
+                           limit: Optional[int] = None, pdf_id: Optional[int] = None) -> list:
+    """Read archived messages in chronological order.
+
+    Returns the newest `limit` messages older than the archived message
+    `before_id` (or the newest overall), optionally only those about one PDF.
+    """
+    found_cursor = before_id is None
+    collected = []
+
+    for path in reversed(_segments(session_code)):
+        # Segments are named by id range, so pages skip straight to the cursor's segment
+        id_range = _segment_range(path)
+        if not found_cursor and id_range and before_id < id_range[0]:
+            continue
+        for message in reversed(_read_segment(path)):
+            if not found_cursor:
+                found_cursor = message["id"] == before_id
+                continue
+            if pdf_id is not None and message["pdf_id"] != pdf_id:
+                continue
+            collected.append(message)
+            if limit is not None and len(collected) >= limit:
+                break
+        if limit is not None and len(collected) >= limit:
+            break
+
+    for message in collected:
+        message["session_id"] = session_id
+        message["created_at"] = datetime.fromisoformat(message["created_at"])
+    return list(reversed(collected))
+
+
+def drop_archive(session_code: str):
+    """Delete all archived history of a session"""
+    shutil.rmtree(_session_folder(session_code), ignore_errors=True)
+
+
+def archive_session(session_id: int, session_code: str, connection) -> int:
+    """Move all but the newest CHAT_HOT_MESSAGES messages of a session to the archive"""
+    cursor = connection.cursor(dictionary=True)
+    archived = 0
+
+    try:
+        cursor.execute(
+            "SELECT id FROM chat_messages WHERE session_id = %s ORDER BY id DESC LIMIT 1 OFFSET %s",
+            (session_id, settings.CHAT_HOT_MESSAGES)
+        )
+        boundary = cursor.fetchone()
+        if not boundary:
+            return 0
+
+        # Rows written to the last segment but not deleted before a crash
+        segments = _segments(session_code)
+        already_archived = {message["id"] for message in _read_segment(segments[-1])} if segments else set()
+
+        while True:
+            cursor.execute(
+                """SELECT id, user_id, pdf_id, message, created_at FROM chat_messages
+                   WHERE session_id = %s AND id <= %s
+                   ORDER BY id LIMIT %s""",
+                (session_id, boundary["id"], settings.CHAT_ARCHIVE_SEGMENT_MESSAGES)
+            )
+            messages = cursor.fetchall()
+            if not messages:
+                break
+
+            pending = [message for message in messages if message["id"] not in already_archived]
+            if pending:
+                for message in pending:
+                    message["created_at"] = message["created_at"].isoformat()
+                _write_segment(session_code, pending)
+                already_archived = {message["id"] for message in pending}
+
+            cursor.execute(
+                "DELETE FROM chat_messages WHERE session_id = %s AND id BETWEEN %s AND %s",
+                (session_id, messages[0]["id"], messages[-1]["id"])
+            )
+            connection.commit()
+            archived += len(pending)
+    finally:
+        cursor.close()
+    return archived
+
+
+def archive_inactive_sessions() -> int:
+    """Archive chat history of every inactive session on every shard"""
+    archived = 0
+    for shard in all_shards():
+        connection = get_db_connection(shard)
+        cursor = connection.cursor()
+        try:
+            # Only one archiver per shard at a time
+            cursor.execute("SELECT GET_LOCK('chat_archive', 0)")
+            if not cursor.fetchone()[0]:
+                print(f"Archive already running on {shard.name}")
+                continue
+
+            # Sessions idle long enough with messages since they were last archived
+            cursor.execute(
+                """
+                SELECT id, session_code, last_message_at FROM sessions
+                WHERE last_message_at < NOW() - INTERVAL %s DAY
+                  AND (archived_at IS NULL OR archived_at < last_message_at)
+                """,
+                (settings.CHAT_ARCHIVE_INACTIVE_DAYS,)
+            )
+            for session_id, session_code, last_message_at in cursor.fetchall():
+                count = archive_session(session_id, session_code, connection)
+                cursor.execute("UPDATE sessions SET archived_at = %s WHERE id = %s", (last_message_at, session_id))
+                connection.commit()
+                if count:
+                    print(f"{session_code}: archived {count} messages")
+                archived += count
+
+            cursor.execute("SELECT RELEASE_LOCK('chat_archive')")
+            cursor.fetchone()
+        finally:
+            cursor.close()
+            connection.close()
+    return archived
+
+
+if __name__ == "__main__":
+    print(f"Archived {archive_inactive_sessions()} messages")
@@ -1,48 +1,185 @@
 import mysql.connector
 from mysql.connector import Error
-from app.config import settings
+from typing import Optional
+from app.sharding import Shard, all_shards, candidate_shards, shard_router
+from app.utils.helpers import get_token_shard_key
+from app.utils.profiling import track_connection
 
 
-def create_database_if_not_exists():
-    """Create the database if it doesn't exist"""
+# Bump whenever init_shard creates or alters anything, so workers know to run it
+SCHEMA_VERSION = 6
+
+
+def create_database_if_not_exists(shard: Shard):
+    """Create the shard's database if it doesn't exist"""
     try:
         connection = mysql.connector.connect(
-            host=settings.DATABASE_HOST,
-            user=settings.DATABASE_USER,
-            password=settings.DATABASE_PASSWORD,
-            port=settings.DATABASE_PORT
+            host=shard.host,
+            user=shard.user,
+            password=shard.password,
+            port=shard.port
         )
         cursor = connection.cursor()
-        cursor.execute(f"CREATE DATABASE IF NOT EXISTS {settings.DATABASE_DB}")
+        cursor.execute(f"CREATE DATABASE IF NOT EXISTS {shard.database}")
         connection.commit()
         cursor.close()
         connection.close()
-        print(f"Database '{settings.DATABASE_DB}' ready")
+        print(f"Database '{shard.name}' ready")
     except Error as e:
         print(f"Error creating database: {e}")
         raise
 
 
-def get_db_connection():
-    """Create and return a database connection"""
+def get_db_connection(shard: Optional[Shard] = None):
+    """Create and return a database connection to a shard (the first one by default)"""
+    shard = shard or shard_router.shards[0]
     try:
         connection = mysql.connector.connect(
-            host=settings.DATABASE_HOST,
-            user=settings.DATABASE_USER,
-            password=settings.DATABASE_PASSWORD,
-            database=settings.DATABASE_DB,
-            port=settings.DATABASE_PORT
+            host=shard.host,
+            user=shard.user,
+            password=shard.password,
+            database=shard.database,
+            port=shard.port
         )
-        return connection
+        return track_connection(connection)
     except Error as e:
         print(f"Error connecting to MySQL: {e}")
         raise
 
 
+def _find_session_shard(session_code: str) -> Optional[Shard]:
+    """Return the shard holding a session, or None if no candidate has it"""
+    for shard in candidate_shards(session_code):
+        connection = get_db_connection(shard)
+        cursor = connection.cursor()
+        try:
+            cursor.execute("SELECT id FROM sessions WHERE session_code = %s", (session_code,))
+            if cursor.fetchone():
+                return shard
+        finally:
+            cursor.close()
+            connection.close()
+    return None
+
+
+def session_shard(session_code: str) -> Shard:
+    """Return the shard a session's queries go to.
+
+    While a rebalance is running (DATABASE_SHARDS_PREVIOUS set), a session
+    that has not been moved yet is still served from its previous shard.
+    """
+    candidates = candidate_shards(session_code)
+    if len(candidates) == 1:
+        return candidates[0]
+    return _find_session_shard(session_code) or candidates[0]
+
+
+def session_exists(session_code: str) -> bool:
+    """Check whether a session code is taken on any shard that may hold it"""
+    return _find_session_shard(session_code) is not None
+
+
+def get_session_connection(session_code: str):
+    """Return a connection to the shard that owns a session"""
+    return get_db_connection(session_shard(session_code))
+
+
+def get_token_connection(user_token: Optional[str]):
+    """Return a connection to the shard that owns a user token.
+
+    Tokens carry their session code as shard key. Tokens issued before
+    sharding have none and are looked up on every shard.
+    """
+    shard_key = get_token_shard_key(user_token)
+    if shard_key:
+        return get_session_connection(shard_key)
+    
+    shards = all_shards()
+    if user_token and len(shards) > 1:
+        for shard in shards:
+            connection = get_db_connection(shard)
+            cursor = connection.cursor()
+            cursor.execute("SELECT id FROM users WHERE user_token = %s", (user_token,))
+            found = cursor.fetchone()
+            cursor.close()
+            if found:
+                return connection
+            connection.close()
+    return get_db_connection()
+
+
 def init_db():
-    """Initialize database tables"""
-    create_database_if_not_exists()
-    connection = get_db_connection()
+    """Initialize database tables on every shard"""
+    for shard in all_shards():
+        init_shard(shard)
+
+
+def get_schema_version(shard: Shard) -> int:
+    """Return the schema version a shard was bootstrapped with, 0 if none"""
+    try:
+        connection = mysql.connector.connect(
+            host=shard.host,
+            user=shard.user,
+            password=shard.password,
+            database=shard.database,
+            port=shard.port
+        )
+    except Error as e:
+        if e.errno == 1049:  # Unknown database
+            return 0
+        raise
+    
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SELECT version FROM schema_version WHERE id = 1")
+        row = cursor.fetchone()
+        return row[0] if row else 0
+    except Error as e:
+        if e.errno == 1146:  # Table doesn't exist
+            return 0
+        raise
+    finally:
+        cursor.close()
+        connection.close()
+
+
+def ensure_schema(lock_timeout: int = 60):
+    """Cheap per-worker startup check that every shard has the current schema.
+
+    Only a shard that is behind gets bootstrapped, by whichever worker wins
+    a MySQL advisory lock; the others wait on the lock and find it done.
+    """
+    for shard in all_shards():
+        if get_schema_version(shard) >= SCHEMA_VERSION:
+            continue
+        
+        connection = mysql.connector.connect(
+            host=shard.host,
+            user=shard.user,
+            password=shard.password,
+            port=shard.port
+        )
+        cursor = connection.cursor()
+        lock_name = f"schema_bootstrap:{shard.database}"
+        try:
+            cursor.execute("SELECT GET_LOCK(%s, %s)", (lock_name, lock_timeout))
+            if not cursor.fetchone()[0]:
+                raise RuntimeError(f"Timed out waiting for schema bootstrap of {shard.name}")
+            
+            if get_schema_version(shard) < SCHEMA_VERSION:
+                init_shard(shard)
+            
+            cursor.execute("SELECT RELEASE_LOCK(%s)", (lock_name,))
+            cursor.fetchone()
+        finally:
+            cursor.close()
+            connection.close()
+
+
+def init_shard(shard: Shard):
+    """Initialize database tables on one shard"""
+    create_database_if_not_exists(shard)
+    connection = get_db_connection(shard)
     cursor = connection.cursor()
     
     try:
@@ -53,10 +190,19 @@ def init_db():
                 session_code VARCHAR(20) UNIQUE NOT NULL,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 is_active BOOLEAN DEFAULT TRUE,
-                expires_at TIMESTAMP
+                expires_at TIMESTAMP,
+                version INT NOT NULL DEFAULT 0,
+                last_message_at TIMESTAMP NULL,
+                archived_at TIMESTAMP NULL,
+                INDEX idx_last_message (last_message_at)
             )
         """)
         
+        # Sessions created before response caching have no version column
+        cursor.execute("SHOW COLUMNS FROM sessions LIKE 'version'")
+        if not cursor.fetchone():
+            cursor.execute("ALTER TABLE sessions ADD COLUMN version INT NOT NULL DEFAULT 0")
+        
         # Create users table (anonymous users in sessions)
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS users (
@@ -96,16 +242,98 @@ def init_db():
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE,
                 FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
-                FOREIGN KEY (pdf_id) REFERENCES pdfs(id) ON DELETE SET NULL
+                FOREIGN KEY (pdf_id) REFERENCES pdfs(id) ON DELETE SET NULL,
+                INDEX idx_session_message (session_id, id),
+                INDEX idx_session_pdf_message (session_id, pdf_id, id)
+            )
+        """)
+        
+        # Message reads page by id within a session
+        cursor.execute("SHOW INDEX FROM chat_messages WHERE Key_name = 'idx_session_message'")
+        if not cursor.fetchall():
+            cursor.execute("""
+                ALTER TABLE chat_messages
+                    ADD INDEX idx_session_message (session_id, id),
+                    ADD INDEX idx_session_pdf_message (session_id, pdf_id, id)
+            """)
+        
+        # The chat archive picks sessions by last activity instead of scanning chat_messages
+        cursor.execute("SHOW COLUMNS FROM sessions LIKE 'last_message_at'")
+        if not cursor.fetchone():
+            cursor.execute("""
+                ALTER TABLE sessions
+                    ADD COLUMN last_message_at TIMESTAMP NULL,
+                    ADD COLUMN archived_at TIMESTAMP NULL,
+                    ADD INDEX idx_last_message (last_message_at)
+            """)
+            cursor.execute("""
+                UPDATE sessions s
+                SET last_message_at = (SELECT MAX(created_at) FROM chat_messages m WHERE m.session_id = s.id)
+            """)
+        
+        # Create queue of users waiting for a PDF to be uploaded
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS allocation_queue (
+                user_id INT PRIMARY KEY,
+                session_id INT NOT NULL,
+                enqueued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE,
+                FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+                INDEX idx_session_enqueued (session_id, enqueued_at)
+            )
+        """)
+        
+        # Create resumable uploads tables
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS pdf_uploads (
+                id CHAR(32) PRIMARY KEY,
+                session_id INT NOT NULL,
+                user_id INT NOT NULL,
+                filename VARCHAR(255) NOT NULL,
+                total_size BIGINT NOT NULL,
+                sha256 CHAR(64),
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE,
+                FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+                INDEX idx_updated_at (updated_at)
+            )
+        """)
+        
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS pdf_upload_chunks (
+                upload_id CHAR(32) NOT NULL,
+                start_offset BIGINT NOT NULL,
+                end_offset BIGINT NOT NULL,
+                PRIMARY KEY (upload_id, start_offset),
+                FOREIGN KEY (upload_id) REFERENCES pdf_uploads(id) ON DELETE CASCADE
             )
         """)
         
+        # Record the schema version last, once everything above succeeded
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                id TINYINT PRIMARY KEY,
+                version INT NOT NULL
+            )
+        """)
+        cursor.execute(
+            "REPLACE INTO schema_version (id, version) VALUES (1, %s)",
+            (SCHEMA_VERSION,)
+        )
+        
         connection.commit()
         print("Database tables initialized successfully")
         
     except Error as e:
         print(f"Error initializing database: {e}")
         connection.rollback()
+        raise
     finally:
         cursor.close()
         connection.close()
+
+
+if __name__ == "__main__":
+    # One-shot bootstrap, e.g. as a release step before starting the workers
+    init_db()
@@ -0,0 +1,205 @@
+"""Move sessions between shards after the shard list changes.
+
+A rebalance runs while the app keeps serving requests:
+
+1. Restart the app with the new list in DATABASE_SHARDS and the old one in
+   DATABASE_SHARDS_PREVIOUS. Sessions are then looked up on their new owner
+   first and on their previous owner until they have been moved, and new
+   sessions are created on their new owner.
+2. Move the sessions, with the same settings:
+
+       python -m app.rebalance plan
+       python -m app.rebalance apply [--session CODE]
+
+3. Remove DATABASE_SHARDS_PREVIOUS and restart the app.
+
+Sessions are moved one at a time, and an interrupted apply can simply be
+run again. The session row is locked on the source shard for the duration
+of the copy, so writes to that session wait until it has been removed from
+the source; those writes then fail once and succeed when retried against
+the new owner. Row ids are reassigned on the
+target shard; archived chat history is loaded back into chat_messages ahead
+of the hot rows so message ids keep their order, and archived again by the
+next archive run. User tokens are copied unchanged and keep routing by
+session code.
+"""
+import argparse
+from app.archive import drop_archive, read_archived_messages
+from app.database import get_db_connection, init_shard
+from app.sharding import Shard, ShardRouter, all_shards, previous_router, shard_router
+
+
+# Tables copied after the session row, in dependency order, with the
+# columns that reference rows of previously copied tables
+SESSION_TABLES = [
+    ("users", {"session_id": "sessions"}),
+    ("pdfs", {"session_id": "sessions", "uploaded_by_user_id": "users"}),
+    ("chat_messages", {"session_id": "sessions", "user_id": "users", "pdf_id": "pdfs"}),
+    ("allocation_queue", {"session_id": "sessions", "user_id": "users"}),
+    ("pdf_uploads", {"session_id": "sessions", "user_id": "users"}),
+    ("pdf_upload_chunks", {}),
+]
+
+# Tables keyed by a generated id instead of AUTO_INCREMENT; the id is kept
+# since partial upload files are named after it
+KEEP_IDS = {"pdf_uploads"}
+
+# Tables without a session_id column, selected through their parent
+SESSION_QUERIES = {
+    "pdf_upload_chunks": """SELECT c.* FROM pdf_upload_chunks c
+                            JOIN pdf_uploads up ON c.upload_id = up.id
+                            WHERE up.session_id = %s ORDER BY 1, 2""",
+}
+
+# References to rows of tables copied later, fixed up once all rows exist
+DEFERRED_REFERENCES = [
+    ("users", "assigned_pdf_id", "pdfs"),
+]
+
+
+def plan_moves(shards: list, target: ShardRouter) -> list:
+    """List (session_code, source, destination) for sessions not on their owner in `target`"""
+    moves = []
+    for shard in shards:
+        connection = get_db_connection(shard)
+        cursor = connection.cursor()
+        try:
+            cursor.execute("SELECT session_code FROM sessions")
+            for (session_code,) in cursor.fetchall():
+                destination = target.shard_for_key(session_code)
+                if destination.name != shard.name:
+                    moves.append((session_code, shard, destination))
+        finally:
+            cursor.close()
+            connection.close()
+    return moves
+
+
+def _insert_row(cursor, table: str, row: dict):
+    if table in KEEP_IDS:
+        columns = list(row)
+    else:
+        columns = [column for column in row if column != "id"]
+    cursor.execute(
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))})",
+        tuple(row[column] for column in columns)
+    )
+    return row["id"] if table in KEEP_IDS else cursor.lastrowid
+
+
+def _restore_archive(cursor, session_code: str, id_maps: dict):
+    """Insert a session's archived messages on the destination, oldest first"""
+    session_id = next(iter(id_maps["sessions"].values()))
+    for message in read_archived_messages(session_code, session_id):
+        user_id = id_maps["users"].get(message["user_id"])
+        if user_id is None:
+            continue
+        message["user_id"] = user_id
+        if message["pdf_id"] is not None:
+            message["pdf_id"] = id_maps["pdfs"].get(message["pdf_id"])
+        _insert_row(cursor, "chat_messages", message)
+
+
+def move_session(session_code: str, source: Shard, destination: Shard) -> bool:
+    """Copy a session with all its rows to another shard, then delete it from the source"""
+    src = get_db_connection(source)
+    dst = get_db_connection(destination)
+    src_cursor = src.cursor(dictionary=True)
+    dst_cursor = dst.cursor(dictionary=True)
+
+    try:
+        # Locking the session row blocks inserts of child rows (foreign key
+        # checks take a shared lock on it) until the source is cleaned up
+        src_cursor.execute("SELECT * FROM sessions WHERE session_code = %s FOR UPDATE", (session_code,))
+        session = src_cursor.fetchone()
+        if not session:
+            src.rollback()
+            return False
+
+        # A previous run committed the copy but did not finish the move. The app
+        # routes to the destination copy from then on, so only clean up.
+        dst_cursor.execute("SELECT id FROM sessions WHERE session_code = %s", (session_code,))
+        if dst_cursor.fetchone():
+            print(f"{session_code}: already copied, removing it from {source.name}")
+            drop_archive(session_code)
+            src_cursor.execute("DELETE FROM sessions WHERE id = %s", (session["id"],))
+            src.commit()
+            return True
+
+        # Rows get new ids on the destination, so cached responses and ETags
+        # of the old version must not be served any more
+        session["version"] += 1
+        # Archived messages are restored to chat_messages below, so archive them again
+        session["archived_at"] = None
+        id_maps = {"sessions": {session["id"]: _insert_row(dst_cursor, "sessions", session)}}
+        deferred = []
+
+        for table, references in SESSION_TABLES:
+            id_maps[table] = {}
+            if table == "chat_messages":
+                _restore_archive(dst_cursor, session_code, id_maps)
+            # Copy in primary key order so new ids keep the original ordering
+            query = SESSION_QUERIES.get(table, f"SELECT * FROM {table} WHERE session_id = %s ORDER BY 1")
+            src_cursor.execute(query, (session["id"],))
+            for row in src_cursor.fetchall():
+                for column, referenced in references.items():
+                    if row[column] is not None:
+                        row[column] = id_maps[referenced].get(row[column])
+                for deferred_table, column, referenced in DEFERRED_REFERENCES:
+                    if deferred_table == table and row[column] is not None:
+                        deferred.append((table, column, referenced, row[column], row["id"]))
+                        row[column] = None
+                new_id = _insert_row(dst_cursor, table, row)
+                if "id" in row:
+                    id_maps[table][row["id"]] = new_id
+
+        for table, column, referenced, old_value, old_id in deferred:
+            dst_cursor.execute(
+                f"UPDATE {table} SET {column} = %s WHERE id = %s",
+                (id_maps[referenced].get(old_value), id_maps[table][old_id])
+            )
+
+        dst.commit()
+        drop_archive(session_code)
+
+        # Child rows go with the session through ON DELETE CASCADE
+        src_cursor.execute("DELETE FROM sessions WHERE id = %s", (session["id"],))
+        src.commit()
+        return True
+    except Exception:
+        dst.rollback()
+        src.rollback()
+        raise
+    finally:
+        src_cursor.close()
+        dst_cursor.close()
+        src.close()
+        dst.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebalance sessions across shards")
+    parser.add_argument("command", choices=["plan", "apply"])
+    parser.add_argument("--session", help="Only move this session code")
+    args = parser.parse_args()
+
+    # The app must already route through both rings, or it would miss moved sessions
+    if previous_router is None:
+        parser.error("set DATABASE_SHARDS_PREVIOUS to the old shard list, as in the running app")
+
+    moves = plan_moves(all_shards(), shard_router)
+    if args.session:
+        moves = [move for move in moves if move[0] == args.session]
+
+    for session_code, source, destination in moves:
+        print(f"{session_code}: {source.name} -> {destination.name}")
+
+    if args.command == "apply":
+        for shard in shard_router.shards:
+            init_shard(shard)
+        moved = sum(move_session(*move) for move in moves)
+        print(f"Moved {moved} of {len(moves)} sessions")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,13 @@
 from fastapi import APIRouter, HTTPException, Header
 from mysql.connector import Error
 from typing import Optional
-from app.database import get_db_connection
+from app.database import get_session_connection
 from app.schemas.schemas import ChatMessageCreate, ChatMessageResponse
-from app.utils.helpers import verify_user_token
+from app.utils.helpers import verify_user_token, bump_session_version
+from app.utils.response_cache import cached_response
+from app.archive import has_archive, read_archived_messages
+from app.utils.analytics import record_event
+from app.utils.search import search_index
 
 router = APIRouter(prefix="/api/chat", tags=["chat"])
 
@@ -11,7 +15,7 @@ router = APIRouter(prefix="/api/chat", tags=["chat"])
 @router.post("/{session_code}/send", response_model=ChatMessageResponse)
 async def send_message(session_code: str, message: ChatMessageCreate, user_token: Optional[str] = Header(None, alias="x-user-token")):
     """Send a chat message"""
-    connection = get_db_connection()
+    connection = get_session_connection(session_code)
     cursor = connection.cursor(dictionary=True)
     
     try:
@@ -43,14 +47,20 @@ async def send_message(session_code: str, message: ChatMessageCreate, user_token
                VALUES (%s, %s, %s, %s)""",
             (session_id, user_id, message.pdf_id, message.message)
         )
+        # Read the insert id before the version UPDATE resets it
+        message_id = cursor.lastrowid
+        bump_session_version(session_id, cursor)
+        cursor.execute("UPDATE sessions SET last_message_at = NOW() WHERE id = %s", (session_id,))
         connection.commit()
         
-        message_id = cursor.lastrowid
+        record_event("message", session_code=session_code, pdf_id=message.pdf_id)
         
         # Get the inserted message
         cursor.execute("SELECT * FROM chat_messages WHERE id = %s", (message_id,))
         saved_message = cursor.fetchone()
         
+        search_index.add_message((session_code, session_id), saved_message)
+        
         return ChatMessageResponse(**saved_message)
     except Error as e:
         connection.rollback()
@@ -61,9 +71,13 @@ async def send_message(session_code: str, message: ChatMessageCreate, user_token
 
 
 @router.get("/{session_code}/messages", response_model=list[ChatMessageResponse])
-async def get_session_messages(session_code: str, user_token: Optional[str] = Header(None, alias="x-user-token"), limit: int = 100):
-    """Get chat messages from a session"""
-    connection = get_db_connection()
+async def get_session_messages(session_code: str, user_token: Optional[str] = Header(None, alias="x-user-token"), limit: int = 100, before_id: Optional[int] = None, if_none_match: Optional[str] = Header(None)):
+    """Get chat messages from a session.
+    
+    Pass the id of the oldest message received as before_id to scroll back;
+    older history is read from the archive once the database runs out.
+    """
+    connection = get_session_connection(session_code)
     cursor = connection.cursor(dictionary=True)
     
     try:
@@ -72,23 +86,46 @@ async def get_session_messages(session_code: str, user_token: Optional[str] = He
             raise HTTPException(status_code=401, detail="Invalid user token")
         
         # Get session
-        cursor.execute("SELECT id FROM sessions WHERE session_code = %s", (session_code,))
+        cursor.execute("SELECT id, version FROM sessions WHERE session_code = %s", (session_code,))
         session = cursor.fetchone()
         
         if not session:
             raise HTTPException(status_code=404, detail="Session not found")
         
-        # Get messages
-        cursor.execute(
-            """SELECT * FROM chat_messages 
-               WHERE session_id = %s 
-               ORDER BY created_at DESC 
-               LIMIT %s""",
-            (session["id"], limit)
-        )
-        messages = cursor.fetchall()
-        
-        return list(reversed(messages))
+        def render():
+            # A cursor that is no longer in the database points into the archive
+            in_database = True
+            if before_id is not None:
+                cursor.execute(
+                    "SELECT id FROM chat_messages WHERE session_id = %s AND id = %s",
+                    (session["id"], before_id)
+                )
+                in_database = cursor.fetchone() is not None
+            
+            messages = []
+            if in_database:
+                # Get messages
+                cursor.execute(
+                    """SELECT * FROM chat_messages 
+                       WHERE session_id = %s AND (%s IS NULL OR id < %s)
+                       ORDER BY id DESC 
+                       LIMIT %s""",
+                    (session["id"], before_id, before_id, limit)
+                )
+                messages = list(reversed(cursor.fetchall()))
+            
+            # Page into the archive past the oldest message still in the database
+            if len(messages) < limit and has_archive(session_code):
+                messages = read_archived_messages(
+                    session_code,
+                    session["id"],
+                    before_id=None if in_database else before_id,
+                    limit=limit - len(messages)
+                ) + messages
+            
+            return [ChatMessageResponse(**m) for m in messages]
+        
+        return cached_response("session_messages", session_code, session["version"], (limit, before_id), if_none_match, render)
     except Error as e:
         raise HTTPException(status_code=500, detail=str(e))
     finally:
@@ -97,9 +134,9 @@ async def get_session_messages(session_code: str, user_token: Optional[str] = He
 
 
 @router.get("/{session_code}/pdf/{pdf_id}/messages", response_model=list[ChatMessageResponse])
-async def get_pdf_messages(session_code: str, pdf_id: int, user_token: Optional[str] = Header(None, alias="user_token")):
+async def get_pdf_messages(session_code: str, pdf_id: int, user_token: Optional[str] = Header(None, alias="user_token"), if_none_match: Optional[str] = Header(None)):
     """Get chat messages for a specific PDF"""
-    connection = get_db_connection()
+    connection = get_session_connection(session_code)
     cursor = connection.cursor(dictionary=True)
     
     try:
@@ -108,22 +145,87 @@ async def get_pdf_messages(session_code: str, pdf_id: int, user_token: Optional[
             raise HTTPException(status_code=401, detail="Invalid user token")
         
         # Get session
-        cursor.execute("SELECT id FROM sessions WHERE session_code = %s", (session_code,))
+        cursor.execute("SELECT id, version FROM sessions WHERE session_code = %s", (session_code,))
         session = cursor.fetchone()
         
         if not session:
             raise HTTPException(status_code=404, detail="Session not found")
         
-        # Get messages for specific PDF
-        cursor.execute(
-            """SELECT * FROM chat_messages 
-               WHERE session_id = %s AND pdf_id = %s 
-               ORDER BY created_at ASC""",
-            (session["id"], pdf_id)
-        )
-        messages = cursor.fetchall()
+        def render():
+            # Get messages for specific PDF
+            cursor.execute(
+                """SELECT * FROM chat_messages 
+                   WHERE session_id = %s AND pdf_id = %s 
+                   ORDER BY created_at ASC""",
+                (session["id"], pdf_id)
+            )
+            messages = cursor.fetchall()
+            
+            if has_archive(session_code):
+                messages = read_archived_messages(session_code, session["id"], pdf_id=pdf_id) + messages
+            
+            return [ChatMessageResponse(**m) for m in messages]
+        
+        return cached_response("pdf_messages", session_code, session["version"], (pdf_id,), if_none_match, render)
+    except Error as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        cursor.close()
+        connection.close()
+
+
+@router.get("/{session_code}/search")
+async def search_messages(session_code: str, q: str, offset: int = 0, limit: int = 20, user_token: Optional[str] = Header(None, alias="x-user-token")):
+    """Full-text search over a session's chat, best matches first"""
+    connection = get_session_connection(session_code)
+    cursor = connection.cursor(dictionary=True)
+    
+    try:
+        # Verify user token
+        if not verify_user_token(user_token):
+            raise HTTPException(status_code=401, detail="Invalid user token")
+        
+        # Get session
+        cursor.execute("SELECT id FROM sessions WHERE session_code = %s", (session_code,))
+        session = cursor.fetchone()
+        
+        if not session:
+            raise HTTPException(status_code=404, detail="Session not found")
         
-        return messages
+        offset = max(offset, 0)
+        limit = max(1, min(limit, 100))
+        
+        index = search_index.get_or_create((session_code, session["id"]))
+        with index.lock:
+            if not index.archive_loaded:
+                for archived in read_archived_messages(session_code, session["id"]):
+                    index.add(archived)
+                index.archive_loaded = True
+            
+            # Catch up with messages written since the last search, including
+            # those sent through other workers
+            cursor.execute(
+                """SELECT * FROM chat_messages 
+                   WHERE session_id = %s AND id > %s 
+                   ORDER BY id""",
+                (session["id"], index.last_id)
+            )
+            for row in cursor.fetchall():
+                index.add(row)
+                index.last_id = row["id"]
+            
+            total, page = index.search(q, offset, limit)
+        
+        return {
+            "query": q,
+            "total": total,
+            "offset": offset,
+            "limit": limit,
+            "hits": [
+                {**ChatMessageResponse(**message).model_dump(), "score": round(score, 4)}
+                for score, message in page
+            ]
+        }
     except Error as e:
         raise HTTPException(status_code=500, detail=str(e))
     finally:
@@ -0,0 +1,28 @@
+from fastapi import APIRouter, HTTPException, Header
+from fastapi.responses import FileResponse
+from typing import Optional
+from app.utils.profiling import is_debug_request, list_profiles, profile_path
+
+router = APIRouter(prefix="/api/debug", tags=["debug"])
+
+
+@router.get("/profiles")
+async def get_recent_profiles(limit: int = 20, debug_token: Optional[str] = Header(None, alias="x-debug-profile")):
+    """List the most recent request profiles"""
+    if not is_debug_request(debug_token):
+        raise HTTPException(status_code=403, detail="Invalid debug token")
+    
+    return list_profiles(limit)
+
+
+@router.get("/profiles/{name}")
+async def download_profile(name: str, debug_token: Optional[str] = Header(None, alias="x-debug-profile")):
+    """Download a speedscope profile"""
+    if not is_debug_request(debug_token):
+        raise HTTPException(status_code=403, detail="Invalid debug token")
+    
+    path = profile_path(name)
+    if not path:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    
+    return FileResponse(path, media_type="application/json", filename=name)
@@ -2,11 +2,15 @@ from fastapi import APIRouter, UploadFile, File, HTTPException, Header
 from fastapi.responses import FileResponse
 from mysql.connector import Error
 import os
+import time
 from typing import Optional
-from app.database import get_db_connection
+from app.database import get_session_connection, get_token_connection
 from app.config import settings
 from app.schemas.schemas import PDFResponse
-from app.utils.helpers import verify_user_token, allocate_random_pdf
+from app.utils.helpers import verify_user_token, allocate_random_pdf, user_has_uploaded, save_pdf_record, enqueue_waiting_user
+from app.utils.notifier import wait_for_session_change, notify_session
+from app.utils.analytics import record_event, record_upload_events
+from app.utils.response_cache import cached_response
 
 router = APIRouter(prefix="/api/pdfs", tags=["pdfs"])
 
@@ -14,7 +18,7 @@ router = APIRouter(prefix="/api/pdfs", tags=["pdfs"])
 @router.post("/upload/{session_code}")
 async def upload_pdf(session_code: str, file: UploadFile = File(...), user_token: Optional[str] = Header(None, alias="x-user-token")):
     """Upload a PDF to a session"""
-    connection = get_db_connection()
+    connection = get_session_connection(session_code)
     cursor = connection.cursor()
     
     try:
@@ -41,12 +45,7 @@ async def upload_pdf(session_code: str, file: UploadFile = File(...), user_token
         user_id = user[0]
         
         # Check if user already uploaded a PDF in this session
-        cursor.execute(
-            "SELECT id FROM pdfs WHERE session_id = %s AND uploaded_by_user_id = %s",
-            (session_id, user_id)
-        )
-        existing_pdf = cursor.fetchone()
-        if existing_pdf:
+        if user_has_uploaded(session_id, user_id, cursor):
             raise HTTPException(status_code=400, detail="You can only upload one PDF per session")
         
         # Save file
@@ -60,12 +59,10 @@ async def upload_pdf(session_code: str, file: UploadFile = File(...), user_token
             f.write(contents)
         
         # Save to database
-        cursor.execute(
-            """INSERT INTO pdfs (session_id, filename, file_path, uploaded_by_user_id, is_available) 
-               VALUES (%s, %s, %s, %s, TRUE)""",
-            (session_id, file.filename, saved_filename, user_id)
-        )
+        pdf_id, assigned = save_pdf_record(session_id, user_id, file.filename, saved_filename, cursor)
         connection.commit()
+        notify_session(session_code)
+        record_upload_events(session_code, pdf_id, assigned)
         
         return {"message": "PDF uploaded successfully", "filename": file.filename}
     except Error as e:
@@ -77,9 +74,9 @@ async def upload_pdf(session_code: str, file: UploadFile = File(...), user_token
 
 
 @router.get("/session/{session_code}", response_model=list[PDFResponse])
-async def get_session_pdfs(session_code: str, user_token: Optional[str] = Header(None, alias="x-user-token")):
+async def get_session_pdfs(session_code: str, user_token: Optional[str] = Header(None, alias="x-user-token"), if_none_match: Optional[str] = Header(None)):
     """Get all PDFs in a session"""
-    connection = get_db_connection()
+    connection = get_session_connection(session_code)
     cursor = connection.cursor(dictionary=True)
     
     try:
@@ -88,20 +85,21 @@ async def get_session_pdfs(session_code: str, user_token: Optional[str] = Header
             raise HTTPException(status_code=401, detail="Invalid user token")
         
         # Get session
-        cursor.execute("SELECT id FROM sessions WHERE session_code = %s", (session_code,))
+        cursor.execute("SELECT id, version FROM sessions WHERE session_code = %s", (session_code,))
         session = cursor.fetchone()
         
         if not session:
             raise HTTPException(status_code=404, detail="Session not found")
         
-        # Get PDFs
-        cursor.execute(
-            "SELECT id, session_id, filename, uploaded_at FROM pdfs WHERE session_id = %s",
-            (session["id"],)
-        )
-        pdfs = cursor.fetchall()
+        def render():
+            # Get PDFs
+            cursor.execute(
+                "SELECT id, session_id, filename, uploaded_at FROM pdfs WHERE session_id = %s",
+                (session["id"],)
+            )
+            return [PDFResponse(**pdf) for pdf in cursor.fetchall()]
         
-        return pdfs
+        return cached_response("session_pdfs", session_code, session["version"], (), if_none_match, render)
     except Error as e:
         raise HTTPException(status_code=500, detail=str(e))
     finally:
@@ -112,7 +110,7 @@ async def get_session_pdfs(session_code: str, user_token: Optional[str] = Header
 @router.get("/download/{pdf_id}")
 async def download_pdf(pdf_id: int, user_token: Optional[str] = Header(None, alias="x-user-token")):
     """Download a PDF"""
-    connection = get_db_connection()
+    connection = get_token_connection(user_token)
     cursor = connection.cursor(dictionary=True)
     
     try:
@@ -120,8 +118,18 @@ async def download_pdf(pdf_id: int, user_token: Optional[str] = Header(None, ali
         if not verify_user_token(user_token):
             raise HTTPException(status_code=401, detail="Invalid user token")
         
-        # Get PDF
-        cursor.execute("SELECT file_path, filename FROM pdfs WHERE id = %s", (pdf_id,))
+        # Get PDF, only from the token's own session: ids are reassigned when a
+        # session moves shards and may then belong to another session
+        cursor.execute(
+            """
+            SELECT p.file_path, p.filename, s.session_code
+            FROM pdfs p
+            JOIN users u ON p.session_id = u.session_id
+            JOIN sessions s ON p.session_id = s.id
+            WHERE p.id = %s AND u.user_token = %s
+            """,
+            (pdf_id, user_token)
+        )
         pdf = cursor.fetchone()
         
         if not pdf:
@@ -132,6 +140,7 @@ async def download_pdf(pdf_id: int, user_token: Optional[str] = Header(None, ali
         if not os.path.exists(file_path):
             raise HTTPException(status_code=404, detail="File not found")
         
+        record_event("download", session_code=pdf["session_code"], pdf_id=pdf_id)
         return FileResponse(file_path, filename=pdf["filename"])
     except Error as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -143,7 +152,7 @@ async def download_pdf(pdf_id: int, user_token: Optional[str] = Header(None, ali
 @router.post("/request-allocation/{session_code}")
 async def request_pdf_allocation(session_code: str, user_token: Optional[str] = Header(None, alias="x-user-token")):
     """Request a random PDF to be assigned to the user"""
-    connection = get_db_connection()
+    connection = get_session_connection(session_code)
     cursor = connection.cursor(dictionary=True)
     
     try:
@@ -151,8 +160,8 @@ async def request_pdf_allocation(session_code: str, user_token: Optional[str] =
         if not verify_user_token(user_token):
             raise HTTPException(status_code=401, detail="Invalid user token")
         
-        # Get session
-        cursor.execute("SELECT id FROM sessions WHERE session_code = %s AND is_active = TRUE", (session_code,))
+        # Get session, locked first so allocation cannot miss a concurrent upload (see lock_session)
+        cursor.execute("SELECT id FROM sessions WHERE session_code = %s AND is_active = TRUE FOR UPDATE", (session_code,))
         session = cursor.fetchone()
         
         if not session:
@@ -161,7 +170,10 @@ async def request_pdf_allocation(session_code: str, user_token: Optional[str] =
         session_id = session["id"]
         
         # Get user
-        cursor.execute("SELECT id, assigned_pdf_id FROM users WHERE user_token = %s", (user_token,))
+        cursor.execute(
+            "SELECT id, assigned_pdf_id, TIMESTAMPDIFF(SECOND, joined_at, NOW()) AS waited FROM users WHERE user_token = %s",
+            (user_token,)
+        )
         user = cursor.fetchone()
         
         if not user:
@@ -173,11 +185,14 @@ async def request_pdf_allocation(session_code: str, user_token: Optional[str] =
             pdf = cursor.fetchone()
             return {"message": "PDF already assigned", "pdf": pdf}
         
-        # Allocate random PDF (not their own)
+        # Allocate random PDF (not their own), otherwise wait for the next upload
         pdf_id = allocate_random_pdf(session_id, user["id"], cursor)
+        if not pdf_id:
+            enqueue_waiting_user(session_id, user["id"], cursor)
         connection.commit()
         
         if pdf_id:
+            record_event("assignment", session_code=session_code, pdf_id=pdf_id, wait_seconds=user["waited"])
             cursor.execute("SELECT id, filename FROM pdfs WHERE id = %s", (pdf_id,))
             pdf = cursor.fetchone()
             return {"message": "PDF assigned successfully", "pdf": pdf}
@@ -191,17 +206,12 @@ async def request_pdf_allocation(session_code: str, user_token: Optional[str] =
         connection.close()
 
 
-@router.get("/my-assigned/{session_code}")
-async def get_my_assigned_pdf(session_code: str, user_token: Optional[str] = Header(None, alias="x-user-token")):
-    """Get the PDF assigned to the current user"""
-    connection = get_db_connection()
+def _fetch_assigned_pdf(session_code: str, user_token: str):
+    """Get the user's assignment row, or None if the user does not exist"""
+    connection = get_session_connection(session_code)
     cursor = connection.cursor(dictionary=True)
     
     try:
-        # Verify user token
-        if not verify_user_token(user_token):
-            raise HTTPException(status_code=401, detail="Invalid user token")
-        
         # Get user with assigned PDF
         cursor.execute(
             """
@@ -212,24 +222,49 @@ async def get_my_assigned_pdf(session_code: str, user_token: Optional[str] = Hea
             """,
             (user_token,)
         )
-        result = cursor.fetchone()
-        
-        if not result:
-            raise HTTPException(status_code=401, detail="User not found")
-        
-        if not result["assigned_pdf_id"]:
-            return {"assigned": False, "pdf": None, "message": "No PDF assigned yet. Request allocation after PDFs are uploaded."}
-        
-        return {
-            "assigned": True,
-            "pdf": {
-                "id": result["id"],
-                "filename": result["filename"],
-                "uploaded_at": result["uploaded_at"]
-            }
-        }
-    except Error as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        return cursor.fetchone()
     finally:
         cursor.close()
         connection.close()
+
+
+@router.get("/my-assigned/{session_code}")
+async def get_my_assigned_pdf(session_code: str, user_token: Optional[str] = Header(None, alias="x-user-token"), wait: int = 0):
+    """Get the PDF assigned to the current user.
+    
+    With wait > 0 the request is held for up to that many seconds until a
+    PDF is assigned, instead of answering immediately.
+    """
+    # Verify user token
+    if not verify_user_token(user_token):
+        raise HTTPException(status_code=401, detail="Invalid user token")
+    
+    deadline = time.monotonic() + min(max(wait, 0), settings.LONG_POLL_MAX_SECONDS)
+    
+    try:
+        while True:
+            result = _fetch_assigned_pdf(session_code, user_token)
+            
+            if not result:
+                raise HTTPException(status_code=401, detail="User not found")
+            
+            remaining = deadline - time.monotonic()
+            if result["assigned_pdf_id"] or remaining <= 0:
+                break
+            
+            # Uploads through this worker wake us up; re-check periodically for the others
+            await wait_for_session_change(session_code, min(remaining, settings.LONG_POLL_RECHECK_SECONDS))
+    except Error as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    if not result["assigned_pdf_id"]:
+        return {"assigned": False, "pdf": None, "message": "No PDF assigned yet. Request allocation after PDFs are uploaded."}
+    
+    return {
+        "assigned": True,
+        "pdf": {
+            "id": result["id"],
+            "filename": result["filename"],
+            "uploaded_at": result["uploaded_at"]
+        }
+    }
@@ -1,9 +1,13 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Header
 from mysql.connector import Error
-from app.database import get_db_connection
+from app.database import get_db_connection, get_session_connection, session_exists
+from app.sharding import shard_router
 from app.schemas.schemas import SessionResponse, JoinSessionRequest, UserResponse
-from app.utils.helpers import generate_session_code, generate_user_token, allocate_random_pdf
+from app.utils.helpers import generate_session_code, generate_user_token, allocate_random_pdf, bump_session_version, enqueue_waiting_user, lock_session
+from app.utils.response_cache import cached_response
+from app.utils.analytics import record_event
 from datetime import datetime
+from typing import Optional
 
 router = APIRouter(prefix="/api/sessions", tags=["sessions"])
 
@@ -11,19 +15,16 @@ router = APIRouter(prefix="/api/sessions", tags=["sessions"])
 @router.post("/create", response_model=SessionResponse)
 async def create_session():
     """Create a new session"""
-    connection = get_db_connection()
+    # Ensure unique session code, also against sessions not yet moved by a rebalance
+    session_code = generate_session_code()
+    while session_exists(session_code):
+        session_code = generate_session_code()
+    
+    # New sessions always go to their owner on the current ring
+    connection = get_db_connection(shard_router.shard_for_key(session_code))
     cursor = connection.cursor()
     
     try:
-        session_code = generate_session_code()
-        
-        # Ensure unique session code
-        while True:
-            cursor.execute("SELECT id FROM sessions WHERE session_code = %s", (session_code,))
-            if not cursor.fetchone():
-                break
-            session_code = generate_session_code()
-        
         cursor.execute(
             "INSERT INTO sessions (session_code, is_active) VALUES (%s, TRUE)",
             (session_code,)
@@ -49,7 +50,7 @@ async def create_session():
 @router.post("/join", response_model=UserResponse)
 async def join_session(request: JoinSessionRequest):
     """Join an existing session"""
-    connection = get_db_connection()
+    connection = get_session_connection(request.session_code)
     cursor = connection.cursor()
     
     try:
@@ -61,21 +62,28 @@ async def join_session(request: JoinSessionRequest):
             raise HTTPException(status_code=404, detail="Session not found")
         
         session_id = session[0]
-        user_token = generate_user_token()
+        user_token = generate_user_token(request.session_code)
         
         # Create user
         cursor.execute(
             "INSERT INTO users (session_id, user_token, is_active) VALUES (%s, %s, TRUE)",
             (session_id, user_token)
         )
-        connection.commit()
-        
+        # Read the insert id before the version UPDATE resets it
         user_id = cursor.lastrowid
+        bump_session_version(session_id, cursor)
+        connection.commit()
         
-        # Allocate random PDF if available
+        # Allocate random PDF if available, otherwise wait for the next upload
+        lock_session(session_id, cursor)
         pdf_id = allocate_random_pdf(session_id, user_id, cursor)
+        if not pdf_id:
+            enqueue_waiting_user(session_id, user_id, cursor)
         connection.commit()
         
+        if pdf_id:
+            record_event("assignment", session_code=request.session_code, pdf_id=pdf_id, wait_seconds=0)
+        
         return {
             "id": user_id,
             "session_id": session_id,
@@ -91,9 +99,9 @@ async def join_session(request: JoinSessionRequest):
 
 
 @router.get("/{session_code}")
-async def get_session_info(session_code: str):
+async def get_session_info(session_code: str, if_none_match: Optional[str] = Header(None)):
     """Get session information"""
-    connection = get_db_connection()
+    connection = get_session_connection(session_code)
     cursor = connection.cursor(dictionary=True)
     
     try:
@@ -103,19 +111,22 @@ async def get_session_info(session_code: str):
         if not session:
             raise HTTPException(status_code=404, detail="Session not found")
         
-        # Get active users count
-        cursor.execute("SELECT COUNT(*) as count FROM users WHERE session_id = %s AND is_active = TRUE", (session["id"],))
-        users_count = cursor.fetchone()["count"]
+        def render():
+            # Get active users count
+            cursor.execute("SELECT COUNT(*) as count FROM users WHERE session_id = %s AND is_active = TRUE", (session["id"],))
+            users_count = cursor.fetchone()["count"]
+            
+            # Get PDFs count
+            cursor.execute("SELECT COUNT(*) as count FROM pdfs WHERE session_id = %s", (session["id"],))
+            pdfs_count = cursor.fetchone()["count"]
+            
+            return {
+                "session": session,
+                "active_users": users_count,
+                "total_pdfs": pdfs_count
+            }
         
-        # Get PDFs count
-        cursor.execute("SELECT COUNT(*) as count FROM pdfs WHERE session_id = %s", (session["id"],))
-        pdfs_count = cursor.fetchone()["count"]
-        
-        return {
-            "session": session,
-            "active_users": users_count,
-            "total_pdfs": pdfs_count
-        }
+        return cached_response("session_info", session_code, session["version"], (), if_none_match, render)
     except Error as e:
         raise HTTPException(status_code=500, detail=str(e))
     finally:
@@ -0,0 +1,353 @@
+from fastapi import APIRouter, HTTPException, Header, Request
+from mysql.connector import Error
+import hashlib
+import os
+import secrets
+import time
+from typing import Optional
+from app.database import get_db_connection, get_session_connection, get_token_connection
+from app.config import settings
+from app.schemas.schemas import UploadCreate
+from app.sharding import all_shards
+from app.utils.helpers import verify_user_token, user_has_uploaded, save_pdf_record
+from app.utils.notifier import notify_session
+from app.utils.analytics import record_upload_events
+
+router = APIRouter(prefix="/api/pdfs/uploads", tags=["uploads"])
+
+# The partial file was removed, by the sweeper or on another host
+UPLOAD_GONE = "Upload data no longer exists; start the upload again"
+
+
+def _partial_path(upload_id: str) -> str:
+    return os.path.join(settings.UPLOAD_FOLDER, "partial", f"{upload_id}.part")
+
+
+def _received_ranges(upload_id: str, cursor) -> list:
+    """Return the received byte ranges of an upload, merged and sorted"""
+    cursor.execute(
+        "SELECT start_offset, end_offset FROM pdf_upload_chunks WHERE upload_id = %s ORDER BY start_offset",
+        (upload_id,)
+    )
+    ranges = []
+    for row in cursor.fetchall():
+        start, end = row["start_offset"], row["end_offset"]
+        if ranges and start <= ranges[-1][1]:
+            ranges[-1][1] = max(ranges[-1][1], end)
+        else:
+            ranges.append([start, end])
+    return ranges
+
+
+def _get_upload(upload_id: str, user_token: Optional[str], cursor) -> dict:
+    """Get an upload owned by the token's user"""
+    if not verify_user_token(user_token):
+        raise HTTPException(status_code=401, detail="Invalid user token")
+    
+    cursor.execute(
+        """
+        SELECT up.*, s.session_code
+        FROM pdf_uploads up
+        JOIN users u ON up.user_id = u.id
+        JOIN sessions s ON up.session_id = s.id
+        WHERE up.id = %s AND u.user_token = %s
+        """,
+        (upload_id, user_token)
+    )
+    upload = cursor.fetchone()
+    
+    if not upload:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return upload
+
+
+def _upload_status(upload: dict, cursor) -> dict:
+    received = _received_ranges(upload["id"], cursor)
+    return {
+        "upload_id": upload["id"],
+        "filename": upload["filename"],
+        "size": upload["total_size"],
+        "chunk_size": settings.UPLOAD_CHUNK_SIZE,
+        "received": received,
+        "complete": received == [[0, upload["total_size"]]]
+    }
+
+
+@router.post("/{session_code}")
+async def create_upload(session_code: str, request: UploadCreate, user_token: Optional[str] = Header(None, alias="x-user-token")):
+    """Start a resumable upload, or resume the caller's matching one"""
+    connection = get_session_connection(session_code)
+    cursor = connection.cursor(dictionary=True)
+    
+    try:
+        # Verify user token
+        if not verify_user_token(user_token):
+            raise HTTPException(status_code=401, detail="Invalid user token")
+        
+        if request.size <= 0 or request.size > settings.MAX_UPLOAD_SIZE:
+            raise HTTPException(status_code=400, detail="Invalid file size")
+        
+        if not request.filename or os.path.basename(request.filename) != request.filename:
+            raise HTTPException(status_code=400, detail="Invalid filename")
+        
+        # Get session
+        cursor.execute("SELECT id FROM sessions WHERE session_code = %s AND is_active = TRUE", (session_code,))
+        session = cursor.fetchone()
+        
+        if not session:
+            raise HTTPException(status_code=404, detail="Session not found")
+        
+        # Get user, locked so concurrent calls cannot start two uploads
+        cursor.execute("SELECT id FROM users WHERE user_token = %s FOR UPDATE", (user_token,))
+        user = cursor.fetchone()
+        
+        if not user:
+            raise HTTPException(status_code=401, detail="User not found")
+        
+        if user_has_uploaded(session["id"], user["id"], cursor):
+            raise HTTPException(status_code=400, detail="You can only upload one PDF per session")
+        
+        # One unfinished upload per user: resume it if it is the same file
+        cursor.execute(
+            "SELECT * FROM pdf_uploads WHERE session_id = %s AND user_id = %s",
+            (session["id"], user["id"])
+        )
+        upload = cursor.fetchone()
+        if upload:
+            if not os.path.exists(_partial_path(upload["id"])):
+                cursor.execute("DELETE FROM pdf_uploads WHERE id = %s", (upload["id"],))
+            elif upload["filename"] != request.filename or upload["total_size"] != request.size:
+                raise HTTPException(
+                    status_code=409,
+                    detail={"message": "Another upload is in progress; abort it first", "upload_id": upload["id"]}
+                )
+            else:
+                return _upload_status(upload, cursor)
+        
+        # Preallocate the file so chunks can be written straight to their offset
+        upload_id = secrets.token_hex(16)
+        path = _partial_path(upload_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            try:
+                os.posix_fallocate(f.fileno(), 0, request.size)
+            except (AttributeError, OSError):
+                f.truncate(request.size)
+        
+        cursor.execute(
+            """INSERT INTO pdf_uploads (id, session_id, user_id, filename, total_size, sha256)
+               VALUES (%s, %s, %s, %s, %s, %s)""",
+            (upload_id, session["id"], user["id"], request.filename, request.size,
+             request.sha256.lower() if request.sha256 else None)
+        )
+        connection.commit()
+        
+        cursor.execute("SELECT * FROM pdf_uploads WHERE id = %s", (upload_id,))
+        return _upload_status(cursor.fetchone(), cursor)
+    except Error as e:
+        connection.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        cursor.close()
+        connection.close()
+
+
+@router.put("/{upload_id}/chunks")
+async def upload_chunk(upload_id: str, offset: int, request: Request, user_token: Optional[str] = Header(None, alias="x-user-token")):
+    """Write a chunk of the file at the given byte offset.
+    
+    Chunks may arrive in parallel and in any order; resending a chunk
+    overwrites the same bytes.
+    """
+    connection = get_token_connection(user_token)
+    cursor = connection.cursor(dictionary=True)
+    
+    try:
+        upload = _get_upload(upload_id, user_token, cursor)
+    except Error as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        cursor.close()
+        connection.close()
+    
+    if offset < 0 or offset >= upload["total_size"]:
+        raise HTTPException(status_code=400, detail="Invalid offset")
+    
+    # Stream without holding a database connection, chunks can take long on slow links
+    limit = min(upload["total_size"] - offset, settings.MAX_UPLOAD_CHUNK_SIZE)
+    written = 0
+    try:
+        fd = os.open(_partial_path(upload_id), os.O_WRONLY)
+    except FileNotFoundError:
+        raise HTTPException(status_code=409, detail=UPLOAD_GONE)
+    try:
+        async for data in request.stream():
+            if written + len(data) > limit:
+                raise HTTPException(status_code=400, detail="Chunk exceeds upload size or chunk limit")
+            os.pwrite(fd, data, offset + written)
+            written += len(data)
+    finally:
+        os.close(fd)
+    
+    if written == 0:
+        raise HTTPException(status_code=400, detail="Empty chunk")
+    
+    connection = get_token_connection(user_token)
+    cursor = connection.cursor(dictionary=True)
+    
+    try:
+        # Only record the range once the bytes are on disk
+        cursor.execute(
+            """INSERT INTO pdf_upload_chunks (upload_id, start_offset, end_offset)
+               VALUES (%s, %s, %s)
+               ON DUPLICATE KEY UPDATE end_offset = GREATEST(end_offset, VALUES(end_offset))""",
+            (upload_id, offset, offset + written)
+        )
+        cursor.execute("UPDATE pdf_uploads SET updated_at = CURRENT_TIMESTAMP WHERE id = %s", (upload_id,))
+        connection.commit()
+        
+        return {"upload_id": upload_id, "offset": offset, "length": written}
+    except Error as e:
+        connection.rollback()
+        if e.errno == 1452:  # Upload row deleted while streaming
+            raise HTTPException(status_code=409, detail=UPLOAD_GONE)
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        cursor.close()
+        connection.close()
+
+
+@router.get("/{upload_id}")
+async def get_upload_status(upload_id: str, user_token: Optional[str] = Header(None, alias="x-user-token")):
+    """Get the byte ranges received so far"""
+    connection = get_token_connection(user_token)
+    cursor = connection.cursor(dictionary=True)
+    
+    try:
+        upload = _get_upload(upload_id, user_token, cursor)
+        return _upload_status(upload, cursor)
+    except Error as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        cursor.close()
+        connection.close()
+
+
+@router.post("/{upload_id}/finalize")
+async def finalize_upload(upload_id: str, user_token: Optional[str] = Header(None, alias="x-user-token")):
+    """Verify a complete upload and add it to the session as the user's PDF"""
+    connection = get_token_connection(user_token)
+    cursor = connection.cursor(dictionary=True)
+    
+    try:
+        upload = _get_upload(upload_id, user_token, cursor)
+        
+        missing = _upload_status(upload, cursor)
+        if not missing["complete"]:
+            raise HTTPException(status_code=409, detail={"message": "Upload incomplete", "received": missing["received"]})
+        
+        path = _partial_path(upload_id)
+        if upload["sha256"]:
+            digest = hashlib.sha256()
+            try:
+                with open(path, "rb") as f:
+                    for block in iter(lambda: f.read(1024 * 1024), b""):
+                        digest.update(block)
+            except FileNotFoundError:
+                raise HTTPException(status_code=409, detail=UPLOAD_GONE)
+            if digest.hexdigest() != upload["sha256"]:
+                raise HTTPException(status_code=422, detail="Checksum mismatch")
+        
+        # Lock the user row so two finalizations cannot both pass the one-PDF check
+        cursor.execute("SELECT id FROM users WHERE id = %s FOR UPDATE", (upload["user_id"],))
+        if user_has_uploaded(upload["session_id"], upload["user_id"], cursor):
+            raise HTTPException(status_code=400, detail="You can only upload one PDF per session")
+        
+        saved_filename = f"{upload['session_code']}_{upload['user_id']}_{upload['filename']}"
+        saved_path = os.path.join(settings.UPLOAD_FOLDER, saved_filename)
+        try:
+            os.replace(path, saved_path)
+        except FileNotFoundError:
+            raise HTTPException(status_code=409, detail=UPLOAD_GONE)
+        
+        try:
+            pdf_id, assigned = save_pdf_record(upload["session_id"], upload["user_id"], upload["filename"], saved_filename, cursor)
+            cursor.execute("DELETE FROM pdf_uploads WHERE id = %s", (upload_id,))
+            connection.commit()
+        except Exception:
+            # Put the file back so the upload can still be finalized
+            os.replace(saved_path, path)
+            raise
+        notify_session(upload["session_code"])
+        record_upload_events(upload["session_code"], pdf_id, assigned)
+        
+        return {"message": "PDF uploaded successfully", "filename": upload["filename"]}
+    except Error as e:
+        connection.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        cursor.close()
+        connection.close()
+
+
+@router.delete("/{upload_id}")
+async def abort_upload(upload_id: str, user_token: Optional[str] = Header(None, alias="x-user-token")):
+    """Abandon an upload and delete its data"""
+    connection = get_token_connection(user_token)
+    cursor = connection.cursor(dictionary=True)
+    
+    try:
+        _get_upload(upload_id, user_token, cursor)
+        cursor.execute("DELETE FROM pdf_uploads WHERE id = %s", (upload_id,))
+        connection.commit()
+        
+        try:
+            os.remove(_partial_path(upload_id))
+        except FileNotFoundError:
+            pass
+        
+        return {"message": "Upload aborted"}
+    except Error as e:
+        connection.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        cursor.close()
+        connection.close()
+
+
+def sweep_abandoned_uploads() -> int:
+    """Delete uploads that received no chunk within UPLOAD_EXPIRE_SECONDS"""
+    removed = 0
+    for shard in all_shards():
+        connection = get_db_connection(shard)
+        cursor = connection.cursor()
+        try:
+            cursor.execute(
+                "SELECT id FROM pdf_uploads WHERE updated_at < NOW() - INTERVAL %s SECOND",
+                (settings.UPLOAD_EXPIRE_SECONDS,)
+            )
+            upload_ids = [row[0] for row in cursor.fetchall()]
+            for upload_id in upload_ids:
+                cursor.execute("DELETE FROM pdf_uploads WHERE id = %s", (upload_id,))
+                try:
+                    os.remove(_partial_path(upload_id))
+                except FileNotFoundError:
+                    pass
+            connection.commit()
+            removed += len(upload_ids)
+        finally:
+            cursor.close()
+            connection.close()
+    
+    # Files left behind without a row, e.g. after a crash during create
+    partial_folder = os.path.join(settings.UPLOAD_FOLDER, "partial")
+    if os.path.isdir(partial_folder):
+        cutoff = time.time() - settings.UPLOAD_EXPIRE_SECONDS
+        for name in os.listdir(partial_folder):
+            path = os.path.join(partial_folder, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+    return removed
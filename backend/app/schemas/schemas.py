@@ -32,6 +32,12 @@ class PDFUpload(BaseModel):
     filename: str
 
 
+class UploadCreate(BaseModel):
+    filename: str
+    size: int
+    sha256: Optional[str] = None
+
+
 class ChatMessageCreate(BaseModel):
     message: str
     pdf_id: Optional[int] = None
@@ -0,0 +1,149 @@
+"""Reading-activity analytics kept off the request path.
+
+Routes call record_event(), which only appends to an in-memory buffer. A
+background thread flushes the buffer in batches, every
+ANALYTICS_FLUSH_INTERVAL seconds or once ANALYTICS_FLUSH_SIZE events are
+waiting, as a gzip member appended to a per-day, per-process JSON lines log
+in ANALYTICS_FOLDER. Reports aggregate over that log, never the OLTP tables:
+
+    python -m app.utils.analytics
+"""
+import gzip
+import json
+import os
+import statistics
+import threading
+import time
+from collections import defaultdict, deque
+from app.config import settings
+
+
+class EventBuffer:
+    """Bounded in-memory event buffer with a background batch writer"""
+
+    def __init__(self, folder: str, flush_size: int, flush_interval: float, max_events: int):
+        self.folder = folder
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_events = max_events
+        self.dropped = 0
+        self._events = deque()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def record(self, event: str, **fields):
+        """Queue an event without blocking; drops it if the buffer is full"""
+        if len(self._events) >= self.max_events:
+            self.dropped += 1
+            return
+        self._events.append({"event": event, "ts": time.time(), **fields})
+        if len(self._events) >= self.flush_size:
+            self._wakeup.set()
+
+    def flush(self) -> int:
+        """Write all buffered events as one compressed batch"""
+        with self._flush_lock:
+            batch = []
+            while self._events:
+                batch.append(self._events.popleft())
+            if not batch:
+                return 0
+
+            os.makedirs(self.folder, exist_ok=True)
+            path = os.path.join(self.folder, f"events-{time.strftime('%Y%m%d')}-{os.getpid()}.jsonl.gz")
+            # Appending a new gzip member keeps the file a valid gzip stream
+            with gzip.open(path, "ab") as f:
+                f.write("".join(json.dumps(event, default=str) + "\n" for event in batch).encode())
+            return len(batch)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except OSError as e:
+                print(f"Error flushing analytics events: {e}")
+
+    def start(self):
+        if self._thread is None:
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="analytics-flush", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopping.set()
+            self._wakeup.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+
+analytics = EventBuffer(
+    settings.ANALYTICS_FOLDER,
+    settings.ANALYTICS_FLUSH_SIZE,
+    settings.ANALYTICS_FLUSH_INTERVAL,
+    settings.ANALYTICS_MAX_BUFFER
+)
+
+
+def record_event(event: str, **fields):
+    """Record an analytics event; pdf events carry session_code and pdf_id"""
+    if settings.ANALYTICS_ENABLED:
+        analytics.record(event, **fields)
+
+
+def record_upload_events(session_code: str, pdf_id: int, assigned: list):
+    """Record an upload and the assignments it made to waiting users"""
+    record_event("upload", session_code=session_code, pdf_id=pdf_id)
+    for _, waited in assigned:
+        record_event("assignment", session_code=session_code, pdf_id=pdf_id, wait_seconds=waited)
+
+
+def read_events(folder: str = None):
+    """Yield every event in the analytics log"""
+    folder = folder or settings.ANALYTICS_FOLDER
+    if not os.path.isdir(folder):
+        return
+    for name in sorted(os.listdir(folder)):
+        if name.endswith(".jsonl.gz"):
+            with gzip.open(os.path.join(folder, name), "rt") as f:
+                for line in f:
+                    yield json.loads(line)
+
+
+def aggregate_pdf_stats(events) -> list:
+    """Per-PDF uploads, downloads, assignments, messages and time to assignment"""
+    stats = defaultdict(lambda: {"downloads": 0, "assignments": 0, "messages": 0, "waits": []})
+    for event in events:
+        if event.get("pdf_id") is None:
+            continue
+        pdf = stats[(event["session_code"], event["pdf_id"])]
+        if event["event"] == "upload":
+            pdf["uploaded_at"] = event["ts"]
+        elif event["event"] == "download":
+            pdf["downloads"] += 1
+        elif event["event"] == "assignment":
+            pdf["assignments"] += 1
+            pdf["waits"].append(event.get("wait_seconds", 0))
+        elif event["event"] == "message":
+            pdf["messages"] += 1
+
+    report = []
+    # Older logs may hold events without a session code
+    for (session_code, pdf_id), pdf in sorted(stats.items(), key=lambda item: (item[0][0] or "", item[0][1])):
+        waits = pdf.pop("waits")
+        report.append({
+            "session_code": session_code,
+            "pdf_id": pdf_id,
+            **pdf,
+            "median_seconds_to_assignment": statistics.median(waits) if waits else None
+        })
+    return report
+
+
+if __name__ == "__main__":
+    print(json.dumps(aggregate_pdf_stats(read_events()), indent=2))
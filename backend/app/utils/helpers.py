@@ -2,6 +2,7 @@ import string
 import random
 import jwt
 from datetime import datetime, timedelta
+from typing import Optional
 from app.config import settings
 
 
@@ -11,13 +12,14 @@ def generate_session_code(length: int = 8) -> str:
     return ''.join(random.choices(characters, k=length))
 
 
-def generate_user_token() -> str:
-    """Generate a unique user token"""
+def generate_user_token(session_code: str) -> str:
+    """Generate a unique user token carrying the session code as shard key"""
     return jwt.encode(
         {
             "exp": datetime.utcnow() + timedelta(days=7),
             "iat": datetime.utcnow(),
-            "data": random.randint(1000000, 9999999)
+            "data": random.randint(1000000, 9999999),
+            "shard": session_code
         },
         settings.SECRET_KEY,
         algorithm=settings.ALGORITHM
@@ -35,6 +37,109 @@ def verify_user_token(token: str) -> bool:
         return False
 
 
+def get_token_shard_key(token: Optional[str]) -> Optional[str]:
+    """Return the shard key encoded in a user token, if any"""
+    if not token:
+        return None
+    try:
+        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+    except jwt.PyJWTError:
+        return None
+    return payload.get("shard")
+
+
+def bump_session_version(session_id: int, cursor):
+    """Mark everything cached for a session as stale"""
+    cursor.execute("UPDATE sessions SET version = version + 1 WHERE id = %s", (session_id,))
+
+
+def lock_session(session_id: int, cursor):
+    """Lock a session row so allocation cannot interleave with an upload.
+
+    Uploads update the session row before draining the allocation queue, so
+    a user allocated under this lock either sees the new PDF or is queued
+    before the drain. Run it first in the transaction: reads after it then
+    see uploads that committed while waiting for the lock.
+    """
+    cursor.execute("SELECT id FROM sessions WHERE id = %s FOR UPDATE", (session_id,))
+    cursor.fetchone()
+
+
+def user_has_uploaded(session_id: int, user_id: int, cursor) -> bool:
+    """Check if a user already uploaded their one PDF in a session"""
+    cursor.execute(
+        "SELECT id FROM pdfs WHERE session_id = %s AND uploaded_by_user_id = %s",
+        (session_id, user_id)
+    )
+    return cursor.fetchone() is not None
+
+
+def save_pdf_record(session_id: int, user_id: int, filename: str, saved_filename: str, cursor) -> tuple:
+    """Record an uploaded PDF file.
+    
+    Returns its id and the (user_id, seconds since joining) of the waiting
+    users it was assigned to.
+    """
+    cursor.execute(
+        """INSERT INTO pdfs (session_id, filename, file_path, uploaded_by_user_id, is_available) 
+           VALUES (%s, %s, %s, %s, TRUE)""",
+        (session_id, filename, saved_filename, user_id)
+    )
+    pdf_id = cursor.lastrowid
+    bump_session_version(session_id, cursor)
+    assigned = drain_allocation_queue(session_id, pdf_id, user_id, cursor)
+    return pdf_id, assigned
+
+
+def enqueue_waiting_user(session_id: int, user_id: int, cursor):
+    """Put a user without a PDF on the session's waiting queue"""
+    # Unlike INSERT IGNORE, this still raises on a foreign key failure
+    cursor.execute(
+        """INSERT INTO allocation_queue (session_id, user_id) VALUES (%s, %s)
+           ON DUPLICATE KEY UPDATE user_id = user_id""",
+        (session_id, user_id)
+    )
+
+
+def drain_allocation_queue(session_id: int, pdf_id: int, uploader_id: int, cursor) -> list:
+    """Assign a newly uploaded PDF to every user waiting in the session.
+
+    The uploader stays queued since nobody gets their own PDF. Runs in the
+    caller's transaction so the assignment commits together with the upload.
+    Returns (user_id, seconds since joining) of the users it assigned.
+    """
+    cursor.execute(
+        """
+        SELECT q.user_id, TIMESTAMPDIFF(SECOND, u.joined_at, NOW()) AS waited, u.assigned_pdf_id
+        FROM allocation_queue q
+        JOIN users u ON q.user_id = u.id
+        WHERE q.session_id = %s AND q.user_id != %s
+        FOR UPDATE
+        """,
+        (session_id, uploader_id)
+    )
+    rows = [tuple(row) if isinstance(row, tuple) else (row.get('user_id'), row.get('waited'), row.get('assigned_pdf_id')) for row in cursor.fetchall()]
+    if not rows:
+        return []
+    
+    # Users assigned a PDF some other way since they queued just leave the queue
+    waiting = [(user_id, waited) for user_id, waited, assigned_pdf_id in rows if assigned_pdf_id is None]
+    if waiting:
+        placeholders = ", ".join(["%s"] * len(waiting))
+        cursor.execute(
+            f"UPDATE users SET assigned_pdf_id = %s WHERE id IN ({placeholders})",
+            (pdf_id, *(user_id for user_id, _ in waiting))
+        )
+    
+    queued_ids = [user_id for user_id, _, _ in rows]
+    placeholders = ", ".join(["%s"] * len(queued_ids))
+    cursor.execute(
+        f"DELETE FROM allocation_queue WHERE user_id IN ({placeholders})",
+        tuple(queued_ids)
+    )
+    return waiting
+
+
 def allocate_random_pdf(session_id: int, user_id: int, cursor):
     """Randomly allocate a PDF to a user in a session (not their own PDF)"""
     try:
@@ -60,6 +165,7 @@ def allocate_random_pdf(session_id: int, user_id: int, cursor):
                 "UPDATE users SET assigned_pdf_id = %s WHERE id = %s",
                 (pdf_id, user_id)
             )
+            bump_session_version(session_id, cursor)
             return pdf_id
         return None
     except Exception as e:
@@ -0,0 +1,30 @@
+import asyncio
+from collections import defaultdict
+
+
+# Long-poll requests of this worker waiting for a change in a session
+_waiters: dict = defaultdict(set)
+
+
+async def wait_for_session_change(session_code: str, timeout: float):
+    """Sleep until the session is notified or the timeout passes.
+
+    Only changes made through this worker wake the waiter early, so callers
+    re-check the database after every wake-up.
+    """
+    event = asyncio.Event()
+    _waiters[session_code].add(event)
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        _waiters[session_code].discard(event)
+        if not _waiters[session_code]:
+            del _waiters[session_code]
+
+
+def notify_session(session_code: str):
+    """Wake every long-poll request waiting on a session"""
+    for event in _waiters.get(session_code, ()):
+        event.set()
@@ -0,0 +1,239 @@
+import hmac
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from contextvars import ContextVar
+from typing import Optional
+from starlette.concurrency import run_in_threadpool
+from app.config import settings
+
+
+# Number of SQL statements executed by the request being profiled.
+# None means the current request is not sampled and nothing is counted.
+_sql_counter: ContextVar[Optional[list]] = ContextVar("sql_counter", default=None)
+
+
+def is_debug_request(header_value: Optional[str]) -> bool:
+    """Check the debug header against the configured profiling token"""
+    if not settings.PROFILE_DEBUG_TOKEN or not header_value:
+        return False
+    return hmac.compare_digest(header_value, settings.PROFILE_DEBUG_TOKEN)
+
+
+class _CountingCursor:
+    """Cursor proxy that counts executed statements for the profiler"""
+
+    def __init__(self, cursor, counter: list):
+        self._cursor = cursor
+        self._counter = counter
+
+    def execute(self, *args, **kwargs):
+        self._counter[0] += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class _CountingConnection:
+    """Connection proxy whose cursors count executed statements"""
+
+    def __init__(self, connection, counter: list):
+        self._connection = connection
+        self._counter = counter
+
+    def cursor(self, *args, **kwargs):
+        return _CountingCursor(self._connection.cursor(*args, **kwargs), self._counter)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+def track_connection(connection):
+    """Wrap a connection so its queries are counted when the request is sampled"""
+    counter = _sql_counter.get()
+    if counter is None:
+        return connection
+    return _CountingConnection(connection, counter)
+
+
+class _StackSampler(threading.Thread):
+    """Periodically capture the call stack of one thread.
+
+    Samples are taken from a separate daemon thread through
+    sys._current_frames(), so the profiled code runs unmodified. Routes
+    execute on the event loop thread, so concurrent requests on the same
+    worker show up in each other's samples.
+    """
+
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.frames: list = []
+        self.frame_index: dict = {}
+        self.samples: list = []
+        self.weights: list = []
+        self._stop_event = threading.Event()
+
+    def run(self):
+        last = time.perf_counter()
+        while not self._stop_event.wait(self.interval):
+            now = time.perf_counter()
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.samples.append(self._stack(frame))
+                self.weights.append(now - last)
+            last = now
+
+    def _stack(self, frame) -> list:
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            key = (code.co_name, code.co_filename, code.co_firstlineno)
+            index = self.frame_index.get(key)
+            if index is None:
+                index = len(self.frames)
+                self.frame_index[key] = index
+                self.frames.append({"name": key[0], "file": key[1], "line": key[2]})
+            stack.append(index)
+            frame = frame.f_back
+        stack.reverse()
+        return stack
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def _speedscope_document(sampler: _StackSampler, name: str, duration: float, metadata: dict) -> dict:
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "name": name,
+        "exporter": "anonymous-pdf-reader",
+        "metadata": metadata,
+        "shared": {"frames": sampler.frames},
+        "profiles": [
+            {
+                "type": "sampled",
+                "name": name,
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": duration,
+                "samples": sampler.samples,
+                "weights": sampler.weights,
+            }
+        ],
+    }
+
+
+def _write_profile(document: dict, filename: str):
+    """Write a profile and drop the oldest ones beyond the ring size"""
+    os.makedirs(settings.PROFILE_FOLDER, exist_ok=True)
+    path = os.path.join(settings.PROFILE_FOLDER, filename)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(document, f)
+    os.replace(tmp_path, path)
+
+    profiles = sorted(_profile_files(), reverse=True)
+    for old in profiles[settings.PROFILE_MAX_FILES:]:
+        try:
+            os.remove(os.path.join(settings.PROFILE_FOLDER, old))
+        except FileNotFoundError:
+            pass
+
+
+def _profile_files() -> list:
+    if not os.path.isdir(settings.PROFILE_FOLDER):
+        return []
+    return [name for name in os.listdir(settings.PROFILE_FOLDER) if name.endswith(".speedscope.json")]
+
+
+def list_profiles(limit: int = 20) -> list:
+    """Return metadata of the most recent profiles, newest first"""
+    profiles = []
+    for name in sorted(_profile_files(), reverse=True)[:limit]:
+        try:
+            with open(os.path.join(settings.PROFILE_FOLDER, name)) as f:
+                metadata = json.load(f).get("metadata", {})
+        except (OSError, ValueError):
+            continue
+        profiles.append({"file": name, **metadata})
+    return profiles
+
+
+def profile_path(name: str) -> Optional[str]:
+    """Resolve a profile file name inside the profile folder"""
+    if name != os.path.basename(name) or name not in _profile_files():
+        return None
+    return os.path.join(settings.PROFILE_FOLDER, name)
+
+
+class ProfilingMiddleware:
+    """Sample a fraction of requests, or those carrying the debug header,
+    with a stack sampler and dump each one as a speedscope profile"""
+
+    def __init__(self, app):
+        self.app = app
+
+    def _should_profile(self, scope) -> bool:
+        # Reading profiles must not push real ones out of the ring
+        if scope["path"].startswith("/api/debug/"):
+            return False
+        for name, value in scope.get("headers", []):
+            if name == b"x-debug-profile":
+                return is_debug_request(value.decode("latin-1"))
+        rate = settings.PROFILE_SAMPLE_RATE
+        return rate > 0 and random.random() < rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self._should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        status = {"code": None}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        counter = [0]
+        token = _sql_counter.set(counter)
+        sampler = _StackSampler(threading.get_ident(), settings.PROFILE_INTERVAL)
+        started_at = time.time()
+        start = time.perf_counter()
+        sampler.start()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            sampler.stop()
+            duration = time.perf_counter() - start
+            _sql_counter.reset(token)
+
+            # The router fills in the matched route and path params on the scope
+            route = getattr(scope.get("route"), "path", scope["path"])
+            session_code = scope.get("path_params", {}).get("session_code")
+            metadata = {
+                "method": scope["method"],
+                "route": route,
+                "path": scope["path"],
+                "session_code": session_code,
+                "status": status["code"],
+                "sql_count": counter[0],
+                "duration_ms": round(duration * 1000, 2),
+                "samples": len(sampler.samples),
+                "started_at": started_at,
+            }
+            slug = re.sub(r"[^A-Za-z0-9]+", "-", route).strip("-") or "root"
+            filename = f"{int(started_at * 1000)}_{os.getpid()}_{slug}.speedscope.json"
+            document = _speedscope_document(sampler, f"{scope['method']} {route}", duration, metadata)
+            try:
+                await run_in_threadpool(_write_profile, document, filename)
+            except OSError as e:
+                print(f"Error writing profile: {e}")
@@ -0,0 +1,69 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response
+from app.config import settings
+
+
+class ResponseCache:
+    """In-memory LRU cache of rendered response bodies bounded by total size"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key) -> Optional[bytes]:
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+            return body
+
+    def put(self, key, body: bytes):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = body
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+
+response_cache = ResponseCache(settings.RESPONSE_CACHE_MAX_BYTES)
+
+
+def make_etag(route: str, session_code: str, version: int, scope: tuple) -> str:
+    """Build an ETag from the session version and what the caller can see"""
+    digest = hashlib.md5(repr((route, session_code, scope)).encode()).hexdigest()[:12]
+    return f'"{version}-{digest}"'
+
+
+def cached_response(route: str, session_code: str, version: int, scope: tuple,
+                    if_none_match: Optional[str], render: Callable) -> Response:
+    """Serve a session-scoped response from its version.
+
+    Responses only change when the session version is bumped, so a matching
+    If-None-Match is answered with 304 and a cached body is reused without
+    calling render. scope holds every request parameter that changes the body.
+    """
+    etag = make_etag(route, session_code, version, scope)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+
+    key = (route, session_code, version, scope)
+    body = response_cache.get(key)
+    if body is None:
+        body = JSONResponse(content=jsonable_encoder(render())).body
+        response_cache.put(key, body)
+
+    return Response(content=body, media_type="application/json", headers=headers)
@@ -0,0 +1,196 @@
+import heapq
+import math
+import re
+import threading
+from collections import OrderedDict
+from typing import Optional
+from app.config import settings
+
+
+_TOKEN_RE = re.compile(r"\w+")
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+# Match counts kept per session for repeated queries
+MAX_CACHED_TOTALS = 256
+
+
+def tokenize(text: str) -> list:
+    return _TOKEN_RE.findall(text.lower())
+
+
+def _gain(groups: list) -> float:
+    """Drop of a term's bound per message scored when expanding its next group"""
+    following = groups[1][0] if len(groups) > 1 else 0.0
+    return (groups[0][0] - following) / len(groups[0][1])
+
+
+class SessionIndex:
+    """Inverted index with BM25 ranking over the chat messages of one session.
+
+    Besides its postings, each term groups its messages by (term frequency,
+    message length). The BM25 impact of a term in a message depends only on
+    that pair and the average length, so adding a message is an append and
+    a query orders a few hundred groups instead of every posting. Top hits
+    are found exactly with Fagin's threshold algorithm, run per message
+    length, which stops once no unscored message can enter the page.
+    """
+
+    def __init__(self):
+        self.postings: dict = {}
+        self.groups: dict = {}
+        self.docs: dict = {}
+        self.lengths: dict = {}
+        self.total_length = 0
+        # Highest message id read from the database; newer rows are caught up on search
+        self.last_id = 0
+        self.archive_loaded = False
+        self.lock = threading.Lock()
+        self._totals: dict = {}
+
+    def add(self, message: dict):
+        message_id = message["id"]
+        if message_id in self.docs:
+            return
+        terms = tokenize(message["message"])
+        length = len(terms)
+        self.docs[message_id] = message
+        self.lengths[message_id] = length
+        self.total_length += length
+
+        counts: dict = {}
+        for term in terms:
+            counts[term] = counts.get(term, 0) + 1
+        # A new message adds one match to every cached query it contains a term of
+        for key in self._totals:
+            if any(term in counts for term in key):
+                self._totals[key] += 1
+
+        for term, count in counts.items():
+            self.postings.setdefault(term, {})[message_id] = count
+            self.groups.setdefault(term, {}).setdefault((count, length), []).append(message_id)
+
+    def search(self, query: str, offset: int, limit: int) -> tuple:
+        """Return the total number of matches and one page of (score, message)"""
+        terms = [term for term in set(tokenize(query)) if term in self.postings]
+        if not terms:
+            return 0, []
+
+        doc_count = len(self.docs)
+        length_norm = K1 * B / (self.total_length / doc_count or 1)
+        base_norm = K1 * (1 - B)
+        scorers = []
+        # Messages of one length, per term: groups as [weighted impact, message ids]
+        # by term frequency, highest first (the impact grows with the frequency)
+        partitions: dict = {}
+        for position, term in enumerate(terms):
+            postings = self.postings[term]
+            document_frequency = len(postings)
+            idf = math.log(1 + (doc_count - document_frequency + 0.5) / (document_frequency + 0.5))
+            scorers.append((idf, postings))
+            for (count, length), message_ids in self.groups[term].items():
+                impact = idf * count * (K1 + 1) / (count + base_norm + length_norm * length)
+                lists = partitions.setdefault(length, [[] for _ in terms])
+                lists[position].append([impact, message_ids])
+        for lists in partitions.values():
+            for groups in lists:
+                groups.sort(key=lambda group: group[0], reverse=True)
+
+        def bound(length: int) -> float:
+            return sum(groups[0][0] for groups in partitions[length] if groups)
+
+        # Threshold algorithm, per message length: an unseen message of some
+        # length scores at most the sum over terms of the best unprocessed
+        # group of that length. Groups of the length with the highest such
+        # bound are expanded until no length can reach the requested page.
+        bounds = [(-bound(length), length) for length in partitions]
+        heapq.heapify(bounds)
+        lengths = self.lengths
+        wanted = offset + limit
+        top: list = []
+        seen = set()
+        while bounds:
+            negative_bound, length = bounds[0]
+            full = len(top) >= wanted
+            if full and top[0][0] > -negative_bound:
+                break
+            lists = partitions[length]
+            heads = [groups[0][0] if groups else 0.0 for groups in lists]
+            total_heads = sum(heads)
+
+            current = max((position for position, groups in enumerate(lists) if groups), key=lambda position: _gain(lists[position]))
+            impact, message_ids = lists[current].pop(0)
+            # Unseen messages of the group score at most its impact plus the
+            # best unprocessed impact of every other term; skip it if that
+            # cannot reach the page
+            if not full or impact + total_heads - heads[current] >= top[0][0]:
+                for message_id in message_ids:
+                    if message_id in seen:
+                        continue
+                    seen.add(message_id)
+                    norm = base_norm + length_norm * lengths[message_id]
+                    score = 0.0
+                    for idf, postings in scorers:
+                        count = postings.get(message_id)
+                        if count:
+                            score += idf * count * (K1 + 1) / (count + norm)
+                    # Best score first, newest message first among equal scores
+                    entry = (score, message_id)
+                    if len(top) < wanted:
+                        heapq.heappush(top, entry)
+                    elif entry > top[0]:
+                        heapq.heapreplace(top, entry)
+            remaining = bound(length)
+            if remaining:
+                heapq.heapreplace(bounds, (-remaining, length))
+            else:
+                heapq.heappop(bounds)
+
+        key = tuple(sorted(terms))
+        total = self._totals.get(key)
+        if total is None:
+            total = len(set().union(*(self.postings[term] for term in terms)))
+            if len(self._totals) >= MAX_CACHED_TOTALS:
+                self._totals.clear()
+            self._totals[key] = total
+
+        page = sorted(top, reverse=True)[offset:]
+        return total, [(score, self.docs[message_id]) for score, message_id in page]
+
+
+class SearchIndex:
+    """Per-session indexes of the sessions searched recently, least recently used evicted"""
+
+    def __init__(self, max_sessions: int):
+        self.max_sessions = max_sessions
+        self._sessions: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key) -> Optional[SessionIndex]:
+        with self._lock:
+            index = self._sessions.get(key)
+            if index is not None:
+                self._sessions.move_to_end(key)
+            return index
+
+    def get_or_create(self, key) -> SessionIndex:
+        with self._lock:
+            index = self._sessions.get(key)
+            if index is None:
+                index = self._sessions[key] = SessionIndex()
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            self._sessions.move_to_end(key)
+            return index
+
+    def add_message(self, key, message: dict):
+        """Index a message just written, if its session's index is loaded"""
+        index = self.get(key)
+        if index is not None:
+            with index.lock:
+                index.add(message)
+
+
+search_index = SearchIndex(settings.SEARCH_MAX_SESSIONS)
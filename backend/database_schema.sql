@@ -8,7 +8,8 @@ CREATE TABLE IF NOT EXISTS sessions (
     session_code VARCHAR(20) UNIQUE NOT NULL,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     is_active BOOLEAN DEFAULT TRUE,
-    expires_at TIMESTAMP NULL
+    expires_at TIMESTAMP NULL,
+    version INT NOT NULL DEFAULT 0
 );
 
 -- Users table (anonymous users in sessions)
@@ -51,5 +52,48 @@ CREATE TABLE IF NOT EXISTS chat_messages (
     FOREIGN KEY (pdf_id) REFERENCES pdfs(id) ON DELETE SET NULL,
     INDEX idx_session_id (session_id),
     INDEX idx_pdf_id (pdf_id),
-    INDEX idx_created_at (created_at)
+    INDEX idx_created_at (created_at),
+    INDEX idx_session_message (session_id, id),
+    INDEX idx_session_pdf_message (session_id, pdf_id, id)
 );
+
+-- Users waiting for a PDF to be uploaded
+CREATE TABLE IF NOT EXISTS allocation_queue (
+    user_id INT PRIMARY KEY,
+    session_id INT NOT NULL,
+    enqueued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE,
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+    INDEX idx_session_enqueued (session_id, enqueued_at)
+);
+
+-- Resumable uploads in progress
+CREATE TABLE IF NOT EXISTS pdf_uploads (
+    id CHAR(32) PRIMARY KEY,
+    session_id INT NOT NULL,
+    user_id INT NOT NULL,
+    filename VARCHAR(255) NOT NULL,
+    total_size BIGINT NOT NULL,
+    sha256 CHAR(64),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE,
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+    INDEX idx_updated_at (updated_at)
+);
+
+-- Byte ranges received for each resumable upload
+CREATE TABLE IF NOT EXISTS pdf_upload_chunks (
+    upload_id CHAR(32) NOT NULL,
+    start_offset BIGINT NOT NULL,
+    end_offset BIGINT NOT NULL,
+    PRIMARY KEY (upload_id, start_offset),
+    FOREIGN KEY (upload_id) REFERENCES pdf_uploads(id) ON DELETE CASCADE
+);
+
+-- Schema version written by the app's bootstrap (see SCHEMA_VERSION in app/database.py)
+CREATE TABLE IF NOT EXISTS schema_version (
+    id TINYINT PRIMARY KEY,
+    version INT NOT NULL
+);
+REPLACE INTO schema_version (id, version) VALUES (1, 5);
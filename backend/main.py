@@ -1,41 +1,45 @@
-from fastapi import FastAPI
+from fastapi import APIRouter, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import PlainTextResponse
 from contextlib import asynccontextmanager
+from starlette.concurrency import run_in_threadpool
+import asyncio
 import os
 from app.config import settings
-from app.database import init_db
-from app.routes import sessions, pdfs, chat
+from app.database import ensure_schema
+from app.routes import sessions, pdfs, uploads, chat, debug
+from app.utils.analytics import analytics
+from app.utils.profiling import ProfilingMiddleware
+
+
+async def sweep_uploads_periodically():
+    """Delete abandoned resumable uploads on a timer"""
+    while True:
+        await asyncio.sleep(settings.UPLOAD_SWEEP_INTERVAL)
+        try:
+            removed = await run_in_threadpool(uploads.sweep_abandoned_uploads)
+            if removed:
+                print(f"Removed {removed} abandoned uploads")
+        except Exception as e:
+            print(f"Error sweeping uploads: {e}")
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Initialize database on startup (after middleware is ready)
-    init_db()
+    # Runs in each worker after fork: only check the schema version here, the
+    # full bootstrap runs once (python -m app.database) or under a DB lock
+    await run_in_threadpool(ensure_schema)
+    sweeper = asyncio.create_task(sweep_uploads_periodically())
+    analytics.start()
     yield
+    sweeper.cancel()
+    analytics.stop()
+
+
+router = APIRouter()
+
 
-app = FastAPI(
-    title="Anonymous PDF Reader Chat",
-    description="A session-based PDF reader with anonymous chat functionality",
-    version="1.0.0",
-    lifespan=lifespan
-)
-
-# CORS middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=False,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-# Include routes
-app.include_router(sessions.router)
-app.include_router(pdfs.router)
-app.include_router(chat.router)
-
-
-@app.get("/robots.txt", response_class=PlainTextResponse)
+@router.get("/robots.txt", response_class=PlainTextResponse)
 async def robots():
     """Serve robots.txt to restrict crawlers"""
     return """User-agent: *
@@ -47,7 +51,7 @@ Disallow: /chat/
 """
 
 
-@app.get("/")
+@router.get("/")
 async def root():
     return {
         "message": "Welcome to Anonymous PDF Reader Chat API",
@@ -56,11 +60,51 @@ async def root():
     }
 
 
-@app.get("/health")
+@router.get("/health")
 async def health():
     return {"status": "ok"}
 
 
+def create_app() -> FastAPI:
+    """Build the application.
+
+    Creating it opens no connections and starts no tasks, so a pre-forking
+    server (gunicorn --preload) can import it once and share the loaded
+    modules between workers.
+    """
+    app = FastAPI(
+        title="Anonymous PDF Reader Chat",
+        description="A session-based PDF reader with anonymous chat functionality",
+        version="1.0.0",
+        lifespan=lifespan
+    )
+    
+    # Opt-in request profiling (PROFILE_SAMPLE_RATE or X-Debug-Profile header)
+    app.add_middleware(ProfilingMiddleware)
+    
+    # CORS middleware
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_credentials=False,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    
+    # Include routes
+    app.include_router(router)
+    app.include_router(sessions.router)
+    app.include_router(pdfs.router)
+    app.include_router(uploads.router)
+    app.include_router(chat.router)
+    app.include_router(debug.router)
+    
+    return app
+
+
+app = create_app()
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
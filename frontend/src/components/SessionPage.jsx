@@ -22,16 +22,27 @@ export function SessionPage({ sessionData, onLeaveSession }) {
   }, [sessionData.session_code])
 
   useEffect(() => {
-    loadAssignedPDF()
-    
     // Poll for updates every 3 seconds
     const interval = setInterval(() => {
-      loadAssignedPDF()
       if (assignedPdf) loadMessages()
     }, 3000)
     return () => clearInterval(interval)
   }, [sessionData])
 
+  // Long-poll until a PDF is assigned; the server answers as soon as one is
+  useEffect(() => {
+    if (assignedPdf) return
+    let cancelled = false
+    const waitForAssignment = async () => {
+      while (!cancelled) {
+        const assigned = await loadAssignedPDF(25)
+        if (assigned) return
+      }
+    }
+    waitForAssignment()
+    return () => { cancelled = true }
+  }, [sessionData, assignedPdf])
+
   useEffect(() => {
     if (assignedPdf) {
       loadMessages()
@@ -46,18 +57,22 @@ export function SessionPage({ sessionData, onLeaveSession }) {
     messagesEndRef.current?.scrollIntoView({ behavior: 'smooth' })
   }
 
-  const loadAssignedPDF = async () => {
+  const loadAssignedPDF = async (wait = 0) => {
     try {
       const response = await pdfAPI.getMyAssignedPDF(
         sessionData.session_code,
-        sessionData.user_token
+        sessionData.user_token,
+        wait
       )
       if (response.data.assigned && response.data.pdf) {
         setAssignedPdf(response.data.pdf)
+        return true
       }
     } catch (error) {
       console.error('Failed to load assigned PDF:', error)
+      await new Promise((resolve) => setTimeout(resolve, 3000))
     }
+    return false
   }
 
   const loadMessages = async () => {
@@ -41,8 +41,9 @@ export const pdfAPI = {
     api.post(`/pdfs/request-allocation/${sessionCode}`, {}, {
       headers: { 'X-User-Token': userToken },
     }),
-  getMyAssignedPDF: (sessionCode, userToken) =>
-    api.get(`/pdfs/my-assigned/${sessionCode}`, {
+  // wait > 0 holds the request on the server until a PDF is assigned or it times out
+  getMyAssignedPDF: (sessionCode, userToken, wait = 0) =>
+    api.get(`/pdfs/my-assigned/${sessionCode}?wait=${wait}`, {
       headers: { 'X-User-Token': userToken },
     }),
 }
@@ -57,6 +58,11 @@ export const chatAPI = {
     api.get(`/chat/${sessionCode}/messages?limit=${limit}`, {
       headers: { 'X-User-Token': userToken },
     }),
+  searchMessages: (sessionCode, query, userToken, offset = 0, limit = 20) =>
+    api.get(`/chat/${sessionCode}/search`, {
+      params: { q: query, offset, limit },
+      headers: { 'X-User-Token': userToken },
+    }),
   getPDFMessages: (sessionCode, pdfId, userToken) =>
     api.get(`/chat/${sessionCode}/pdf/${pdfId}/messages`, {
       headers: { 'X-User-Token': userToken },